@@ -1,15 +1,18 @@
 import os
 import json
+import orjson
 import logging
 import re
 import time
+import random
+import asyncio
 import argparse
 from datetime import datetime
 from pathlib import Path
 from langchain_google_genai import ChatGoogleGenerativeAI
-from tavily import TavilyClient
-from schema import StoryAnalysis
-from tools import fetch_hn_top_stories, fetch_rss_feed, validate_analysis, safe_get_market_snapshot, normalize_url
+from tavily import AsyncTavilyClient
+from schema import StoryAnalysis, Story
+from tools import fetch_hn_top_stories, fetch_rss_feed, validate_analysis, safe_get_market_snapshot, normalize_url, SlidingWindowLimiter
 
 # Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,11 +22,21 @@ logger = logging.getLogger(__name__)
 BASE_DIR = Path(__file__).resolve().parent
 REPO_ROOT = BASE_DIR.parent
 REPORT_PATH = BASE_DIR / "run_report.json"
+TRACE_PATH = BASE_DIR / "run_report.trace.jsonl"
 OUTPUT_DIR = REPO_ROOT / "src/content/news"
 
 # Constants
 MAX_RETRIES = 2
 MIN_CONTENT_LENGTH = 300 
+SOURCE_CONTEXT_CHARS = 600  # Per-source snippet cap (~150 tokens)
+SEED_CONCURRENCY = 2  # Bounds in-flight Tavily + Gemini work
+MAX_RETRY_DELAY = 30
+NON_RETRYABLE_STATUS = {400, 401, 403}
+# Proactive provider quotas (Gemini 2.0 Flash free tier, Tavily dev tier)
+_GEMINI_LIMITER = SlidingWindowLimiter(rpm=15, tpm=1_000_000)
+_TAVILY_LIMITER = SlidingWindowLimiter(rpm=100)
+REPORT_SAVE_INTERVAL = 1.0  # Seconds between unforced report writes
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)\s*```", re.IGNORECASE)
 
 # Source Registry
 SOURCE_PRESETS = {
@@ -39,17 +52,33 @@ run_report = {
     "timestamp": datetime.now().isoformat(),
     "status": "started",
     "metrics": {"seeded": 0, "processed": 0, "failed": 0, "skipped": 0},
-    "trace": [] 
 }
+_trace_file = None
 
-def save_report():
+_last_report_save = 0.0
+
+def save_report(force=False):
+    """Snapshots run_report. Unforced calls are throttled; forced ones mark phase boundaries."""
+    global _last_report_save
+    now = time.monotonic()
+    if not force and now - _last_report_save < REPORT_SAVE_INTERVAL: return
+    _last_report_save = now
     os.makedirs(REPORT_PATH.parent, exist_ok=True)
-    with open(REPORT_PATH, "w", encoding="utf-8") as f:
-        json.dump(run_report, f, indent=2)
+    # Write-then-rename so an interrupted run never leaves a torn report
+    tmp = REPORT_PATH.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps(run_report, option=orjson.OPT_INDENT_2 if force else None))
+    os.replace(tmp, REPORT_PATH)
+
+def record_trace(entry):
+    """Appends one event to the ND-JSON trace (kept out of the report snapshot)."""
+    if _trace_file is None: return
+    _trace_file.write(orjson.dumps(entry) + b"\n")
+    _trace_file.flush()
 
 def coerce_llm_text(response) -> str:
     """Safely extracts text from various LangChain message formats."""
-    raw = getattr(response, "content", None)
+    # Fast path: chat models hand back a message whose .content is already a str
+    if isinstance(raw := getattr(response, "content", None), str): return raw
     if raw is None:
         raw = getattr(response, "text", "")
     if isinstance(raw, str): return raw
@@ -64,16 +93,22 @@ def coerce_llm_text(response) -> str:
 
 def extract_json_block(text):
     text = text.strip()
-    try: return json.loads(text)
-    except json.JSONDecodeError: pass
-    match = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text, re.IGNORECASE)
-    if match:
-        try: return json.loads(match.group(1))
-        except: pass 
-    try: return json.loads(text[text.index('{'):text.rindex('}')+1])
-    except: pass
-    try: return json.loads(text[text.index('['):text.rindex(']')+1])
-    except: return None
+    lead = text[:1]
+    if lead in ("{", "["):
+        try: return orjson.loads(text)
+        except orjson.JSONDecodeError: pass
+    elif lead == "`":
+        # Only fenced responses pay for the codefence regex
+        match = _CODE_FENCE_RE.search(text)
+        if match:
+            try: return orjson.loads(match.group(1))
+            except orjson.JSONDecodeError: pass
+    for open_ch, close_ch in (("{", "}"), ("[", "]")):
+        first, last = text.find(open_ch), text.rfind(close_ch)
+        if first == -1 or last < first: continue
+        try: return orjson.loads(text[first:last+1])
+        except orjson.JSONDecodeError: pass
+    return None
 
 def _coerce_tavily_result(r):
     if isinstance(r, dict): return r
@@ -84,6 +119,40 @@ def _coerce_tavily_result(r):
         "title": getattr(r, "title", None),
     }
 
+def _error_status(err):
+    """Best-effort HTTP status code from SDK exceptions (or their cause)."""
+    for e in (err, err.__cause__):
+        if e is None: continue
+        for attr in ("status_code", "code", "status"):
+            val = getattr(e, attr, None)
+            if isinstance(val, int): return val
+        val = getattr(getattr(e, "response", None), "status_code", None)
+        if isinstance(val, int): return val
+    return None
+
+def _retry_after(err):
+    """Reads Retry-After / x-ratelimit-reset (in seconds) from a failed response, if any."""
+    for e in (err, err.__cause__):
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if not headers: continue
+        headers = {str(k).lower(): v for k, v in headers.items()}
+        for key in ("retry-after", "x-ratelimit-reset"):
+            try: val = float(headers[key])
+            except (KeyError, TypeError, ValueError): continue
+            if val > 1e9: val -= time.time()  # Epoch-style reset timestamp
+            return max(0.0, val)
+    return None
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars/token) for limiter accounting."""
+    return len(text) // 4 + 1
+
+def retry_delay(err, attempt):
+    """Server-provided wait if present, else capped exponential backoff with jitter."""
+    retry_after = _retry_after(err)
+    if retry_after is not None: return min(retry_after, MAX_RETRY_DELAY)
+    return min(2 ** attempt + random.random(), MAX_RETRY_DELAY)
+
 def get_seeds(source_arg):
     """Determines seeds based on the command-line argument."""
     source_input = source_arg.lower()
@@ -107,7 +176,173 @@ def get_seeds(source_arg):
     logger.warning(f"Unknown source '{source_input}', defaulting to Hacker News")
     return fetch_hn_top_stories(limit=3)
 
-def main():
+def build_prompt(ctx) -> str:
+    return f"""
+    You are a strict financial analyst. 
+    STORY: {ctx["title"]}
+    CONTEXT: {ctx["context_text"]}
+    
+    SEED URL (Reference Only): {ctx["seed_url_redacted"]}
+    PRIMARY CITATION TARGET: {ctx["primary_allowed_url"]}
+    
+    TASK: Write 2-3 bullet points summarizing the story.
+    
+    CRITICAL RULES:
+    1. Return ONLY a valid JSON object.
+    2. Every bullet MUST end with the citation format: [Source Name](URL)
+    3. DO NOT add a trailing period after the citation.
+    4. Use URLs from this list ONLY: {json.dumps(ctx["allowed_urls"])}
+    5. If context is insufficient, return "bullets": []
+    
+    OUTPUT SCHEMA: {{"bullets": ["Bullet text [Source](URL)", "Another bullet [Source](URL)"]}}
+    """.strip()
+
+async def enrich_seed(seed, tavily, sem):
+    """Searches Tavily for a seed and builds its prompt context. Returns a context dict or None."""
+    title = seed.get('title', 'Untitled Story')
+    seed_url = normalize_url(seed.get('url', ''))
+    
+    if not seed_url:
+        logger.warning(f"Skipping {title}: Missing URL")
+        run_report["metrics"]["skipped"] += 1
+        save_report()
+        return None
+
+    logger.info(f"Enriching: {title}")
+    raw_results_list = []
+    try:
+        async with sem:
+            await _TAVILY_LIMITER.acquire()
+            search_result = await tavily.search(query=title, search_depth="basic", max_results=3)
+        if isinstance(search_result, dict): raw_results_list = search_result.get("results", []) or []
+        elif isinstance(search_result, list): raw_results_list = search_result
+        else: raw_results_list = getattr(search_result, "results", []) or []
+    except Exception as e:
+        logger.warning(f"Tavily search failed: {e}")
+    
+    tavily_results = [_coerce_tavily_result(r) for r in raw_results_list]
+    valid_results = [r for r in tavily_results if r.get('url') and r.get('content')]
+    
+    total_content = "".join([str(r.get('content', '') or "") for r in valid_results])
+    if len(total_content) < MIN_CONTENT_LENGTH:
+        logger.info(f"Skipping {title}: Insufficient content")
+        run_report["metrics"]["skipped"] += 1
+        save_report()
+        return None
+
+    # (url, snippet) per source, in Tavily's order
+    sources = [(normalize_url(str(r.get('url', ''))), _truncate_snippet(str(r.get('content', '') or '')))
+               for r in valid_results]
+    ctx = _build_context(title, seed_url, sources)
+
+    if not ctx:
+        logger.info(f"Skipping {title}: No valid allowed URLs")
+        run_report["metrics"]["skipped"] += 1
+        save_report()
+        return None
+    return ctx
+
+def _truncate_snippet(text: str, width: int = SOURCE_CONTEXT_CHARS) -> str:
+    """Collapses whitespace and cuts at the last word boundary within width (hard cut if none is near)."""
+    text = " ".join(text.split())
+    if len(text) <= width: return text
+    cut = text.rfind(" ", 0, width)
+    # No usable boundary (CJK text, a long leading URL): fall back to a plain slice
+    if cut < width // 2: cut = width - 1
+    return text[:cut].rstrip() + "…"
+
+def _build_context(title, seed_url, sources):
+    """Builds the prompt context from (url, snippet) sources. Returns None without URLs."""
+    allowed_urls = list(dict.fromkeys(url for url, _ in sources))  # Order-preserving dedup
+    if not allowed_urls: return None
+
+    # Bullet URLs go through normalize_url again at validation time (which unquotes
+    # once more), so the allowlist must get the same pass to compare like with like
+    allowed_set = frozenset(normalize_url(u) for u in allowed_urls)
+    ctx = {
+        "title": title,
+        "seed_url": seed_url,
+        "seed_url_redacted": seed_url.replace("https://", "hxxps://").replace("http://", "hxxp://"),
+        "allowed_urls": allowed_urls,
+        "allowed_set": allowed_set,
+        "primary_allowed_url": seed_url if seed_url in allowed_urls else allowed_urls[0],
+        "context_text": "\n".join(f"- {snippet} (Source: {url})" for url, snippet in sources),
+    }
+    ctx["prompt"] = build_prompt(ctx)
+    return ctx
+
+async def analyze_story(ctx, llm, first_response, sem):
+    """Validates the batched first response, re-asking the LLM on failure. Returns a Story or None."""
+    title = ctx["title"]
+    story = None
+    story_success = False
+    last_err = None
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if attempt == 0:
+                response = first_response
+                if isinstance(response, Exception): raise response
+            else:
+                async with sem:
+                    await _GEMINI_LIMITER.acquire(_estimate_tokens(ctx["prompt"]))
+                    response = await llm.ainvoke(ctx["prompt"])
+            data = extract_json_block(coerce_llm_text(response))
+            if data is None: raise ValueError("Failed to parse JSON")
+            
+            analysis = StoryAnalysis(**data) 
+            if len(analysis.bullets) == 0:
+                logger.info(f"Skipping {title} (LLM returned empty)")
+                run_report["metrics"]["skipped"] += 1
+                story_success = True 
+                break
+
+            validate_analysis(analysis.model_dump(), ctx["allowed_set"])
+            # yfinance is blocking; keep it off the event loop
+            market_str = await asyncio.to_thread(safe_get_market_snapshot, title)
+            
+            story = Story(
+                title=title,
+                market_data=market_str,
+                bullets=analysis.bullets,
+                source=ctx["primary_allowed_url"],
+                seed_canonical=ctx["seed_url"],
+            )
+            
+            run_report["metrics"]["processed"] += 1
+            record_trace({"title": title, "status": "success"})
+            story_success = True
+            break 
+        except Exception as e:
+            last_err = str(e)
+            if _error_status(e) in NON_RETRYABLE_STATUS:
+                logger.warning(f"Attempt {attempt+1} failed for '{title}' (not retryable): {e}")
+                break
+            logger.warning(f"Attempt {attempt+1} failed for '{title}': {e}")
+            if attempt < MAX_RETRIES:
+                delay = retry_delay(e, attempt)
+                # A quota hit applies to every in-flight story, not just this one
+                if _error_status(e) == 429: _GEMINI_LIMITER.defer(delay)
+                await asyncio.sleep(delay)
+
+    if not story_success:
+        run_report["metrics"]["failed"] += 1
+        record_trace({"title": title, "status": "failed", "error": last_err})
+    save_report() 
+    return story
+
+def _drop_failures(results):
+    """Counts and logs exceptions from asyncio.gather; returns the non-empty results."""
+    kept = []
+    for r in results:
+        if isinstance(r, BaseException):
+            logger.error(f"Critical error: {r}")
+            run_report["metrics"]["failed"] += 1
+        elif r:
+            kept.append(r)
+    return kept
+
+async def main():
     # --- ARGUMENT PARSING ---
     parser = argparse.ArgumentParser(description="Run the AI News Analyst.")
     parser.add_argument(
@@ -123,148 +358,56 @@ def main():
     if not api_key: raise RuntimeError("Missing GOOGLE_API_KEY")
     if "TAVILY_API_KEY" not in os.environ: raise RuntimeError("Missing TAVILY_API_KEY")
 
-    save_report()
+    save_report(force=True)
+    global _trace_file
+    _trace_file = open(TRACE_PATH, "wb")  # Fresh trace per run
     
     try:
         llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0, google_api_key=api_key)
-        tavily = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+        tavily = AsyncTavilyClient(api_key=os.environ["TAVILY_API_KEY"])
         
-        # DYNAMIC FETCHING
-        seeds = get_seeds(args.source)
+        # DYNAMIC FETCHING (blocking HTTP; run off the event loop)
+        seeds = await asyncio.to_thread(get_seeds, args.source)
         
         run_report["metrics"]["seeded"] = len(seeds)
-        save_report()
+        save_report(force=True)
 
-        final_stories = []
+        # The semaphore is the rate limit protection for every fan-out below
+        sem = asyncio.Semaphore(SEED_CONCURRENCY)
 
-        for seed in seeds:
-            time.sleep(10) # Rate limit protection
-            
-            title = seed.get('title', 'Untitled Story')
-            seed_url = normalize_url(seed.get('url', ''))
-            
-            if not seed_url:
-                logger.warning(f"Skipping {title}: Missing URL")
-                run_report["metrics"]["skipped"] += 1
-                save_report()
-                continue
-
-            try:
-                logger.info(f"Enriching: {title}")
-                raw_results_list = []
-                try:
-                    search_result = tavily.search(query=title, search_depth="basic", max_results=3)
-                    if isinstance(search_result, dict): raw_results_list = search_result.get("results", []) or []
-                    elif isinstance(search_result, list): raw_results_list = search_result
-                    else: raw_results_list = getattr(search_result, "results", []) or []
-                except Exception as e:
-                    logger.warning(f"Tavily search failed: {e}")
-                
-                tavily_results = [_coerce_tavily_result(r) for r in raw_results_list]
-                valid_results = [r for r in tavily_results if r.get('url') and r.get('content')]
-                
-                total_content = "".join([str(r.get('content', '') or "") for r in valid_results])
-                if len(total_content) < MIN_CONTENT_LENGTH:
-                    logger.info(f"Skipping {title}: Insufficient content")
-                    run_report["metrics"]["skipped"] += 1
-                    save_report()
-                    continue
-
-                raw_allowed_urls = [normalize_url(str(r.get('url', ''))) for r in valid_results]
-                seen = set()
-                allowed_urls = [u for u in raw_allowed_urls if not (u in seen or seen.add(u))]
-                
-                if not allowed_urls:
-                    logger.info(f"Skipping {title}: No valid allowed URLs")
-                    run_report["metrics"]["skipped"] += 1
-                    save_report()
-                    continue
-
-                primary_allowed_url = seed_url if seed_url in allowed_urls else allowed_urls[0]
-                seed_url_redacted = seed_url.replace("https://", "hxxps://").replace("http://", "hxxp://")
-
-                context_lines = []
-                for r in valid_results:
-                    content = str(r.get('content', '') or '').replace("\n", " ").strip()[:600]
-                    url_str = normalize_url(str(r.get('url', '')))
-                    context_lines.append(f"- {content} (Source: {url_str})")
-                context_text = "\n".join(context_lines)
-
-                story_success = False
-                last_err = None
-
-                for attempt in range(MAX_RETRIES + 1):
-                    try:
-                        prompt = f"""
-                        You are a strict financial analyst. 
-                        STORY: {title}
-                        CONTEXT: {context_text}
-                        
-                        SEED URL (Reference Only): {seed_url_redacted}
-                        PRIMARY CITATION TARGET: {primary_allowed_url}
-                        
-                        TASK: Write 2-3 bullet points summarizing the story.
-                        
-                        CRITICAL RULES:
-                        1. Return ONLY a valid JSON object.
-                        2. Every bullet MUST end with the citation format: [Source Name](URL)
-                        3. DO NOT add a trailing period after the citation.
-                        4. Use URLs from this list ONLY: {json.dumps(allowed_urls)}
-                        5. If context is insufficient, return "bullets": []
-                        
-                        OUTPUT SCHEMA: {{"bullets": ["Bullet text [Source](URL)", "Another bullet [Source](URL)"]}}
-                        """.strip()
-                        
-                        response = llm.invoke(prompt)
-                        data = extract_json_block(coerce_llm_text(response))
-                        if data is None: raise ValueError("Failed to parse JSON")
-                        
-                        analysis = StoryAnalysis(**data) 
-                        if len(analysis.bullets) == 0:
-                            logger.info(f"Skipping {title} (LLM returned empty)")
-                            run_report["metrics"]["skipped"] += 1
-                            story_success = True 
-                            break
-
-                        validate_analysis(analysis.model_dump(), allowed_urls)
-                        market_str = safe_get_market_snapshot(title)
-                        
-                        final_stories.append({
-                            "title": title,
-                            "market_data": market_str,
-                            "bullets": analysis.bullets,
-                            "source": primary_allowed_url,
-                            "seed_canonical": seed_url
-                        })
-                        
-                        run_report["metrics"]["processed"] += 1
-                        run_report["trace"].append({"title": title, "status": "success"})
-                        story_success = True
-                        break 
-                    except Exception as e:
-                        last_err = str(e)
-                        time.sleep(5 * (attempt + 1)) 
-                        logger.warning(f"Attempt {attempt+1} failed for '{title}': {e}")
-
-                if not story_success:
-                    run_report["metrics"]["failed"] += 1
-                    run_report["trace"].append({"title": title, "status": "failed", "error": last_err})
-            except Exception as e:
-                 logger.error(f"Critical error: {e}")
-                 run_report["metrics"]["failed"] += 1
-            save_report() 
+        # Phase 1: all Tavily searches in one concurrent fan-out
+        enriched = await asyncio.gather(*(enrich_seed(s, tavily, sem) for s in seeds), return_exceptions=True)
+        contexts = _drop_failures(enriched)
+
+        # Phase 2: first LLM attempt for every story in one batched round-trip
+        first_responses = []
+        if contexts:
+            for c in contexts:
+                await _GEMINI_LIMITER.acquire(_estimate_tokens(c["prompt"]))
+            first_responses = await llm.abatch(
+                [c["prompt"] for c in contexts],
+                config={"max_concurrency": SEED_CONCURRENCY},
+                return_exceptions=True,
+            )
+
+        # Phase 3: validate; only failed stories go back to the LLM
+        results = await asyncio.gather(
+            *(analyze_story(c, llm, r, sem) for c, r in zip(contexts, first_responses)),
+            return_exceptions=True,
+        )
+        final_stories = _drop_failures(results)
 
         if not final_stories:
             logger.warning("No stories generated.")
             run_report["status"] = "completed_empty"
-            save_report()
+            save_report(force=True)
             return
 
         date_str = datetime.now().strftime("%Y-%m-%d")
         filename = OUTPUT_DIR / f"{date_str}.md"
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         
-        md_content = f"""---
+        header = f"""---
 title: "Daily Briefing: {date_str}"
 pubDate: "{date_str}"
 description: "AI-curated analysis of {len(final_stories)} tech stories."
@@ -272,25 +415,25 @@ tags: ["tech", "ai"]
 ---
 # ☕ Daily Tech Briefing
 """
-        for s in final_stories:
-            md_content += f"## [{s['title']}]({s['source']}){s['market_data']}\n"
-            for b in s['bullets']:
-                md_content += f"* {b}\n"
-            md_content += "\n"
-
         with open(filename, "w", encoding="utf-8") as f:
-            f.write(md_content)
+            f.write(header)
+            for s in final_stories:
+                f.write(f"## [{s.title}]({s.source}){s.market_data}\n")
+                f.writelines(f"* {b}\n" for b in s.bullets)
+                f.write("\n")
         
         logger.info(f"Published to {filename}")
         run_report["status"] = "success"
-        save_report()
+        save_report(force=True)
 
     except Exception as e:
         logger.critical(f"Run failed: {e}")
         run_report["status"] = "failed"
         run_report["error"] = str(e)
-        save_report()
+        save_report(force=True)
         exit(1)
+    finally:
+        _trace_file.close()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
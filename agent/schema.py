@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from typing import List
 from pydantic import BaseModel, Field, field_validator
 
@@ -10,3 +11,12 @@ class StoryAnalysis(BaseModel):
         if not (2 <= len(v) <= 3):
             raise ValueError(f"Bullet count {len(v)} is out of bounds (must be 0 or 2-3).")
         return v
+
+@dataclass(slots=True)
+class Story:
+    """A validated story, ready to publish."""
+    title: str
+    market_data: str
+    bullets: List[str]
+    source: str
+    seed_canonical: str
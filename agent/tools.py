@@ -1,63 +1,111 @@
-import os
 import re
 import math
+import time
+import asyncio
+import functools
+import queue
+import threading
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import io
 import xml.etree.ElementTree as ET
 import yfinance as yf
 import warnings
+from collections import deque
 from datetime import datetime, timezone
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, unquote
-from multiprocessing import Process, Queue
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+try:
+    from lxml import etree
+except ImportError:  # Fall back to the stdlib full-DOM parse
+    etree = None
 
 # Suppress yfinance warnings
 warnings.filterwarnings("ignore", category=FutureWarning, message=".*Timestamp.utcnow is deprecated.*")
 
 logger = logging.getLogger(__name__)
 
+HN_WORKERS = 16
+
+# Shared keep-alive session: one TCP/TLS handshake per host instead of per request.
+# Transient failures (429/5xx) are retried at the transport level with short backoff only;
+# Retry-After is ignored because urllib3 would sleep its full (uncapped) value.
+SESSION = requests.Session()
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+})
+_ADAPTER = HTTPAdapter(
+    pool_connections=32, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=False, raise_on_status=False),
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)  # Custom RSS feeds may still be plain HTTP
+
 # --- 1. SIGNAL (THE SCOUT) ---
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
 
-def fetch_rss_feed(feed_url, limit=3):
-    """Generic fetcher for ANY RSS feed."""
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        resp = requests.get(feed_url, headers=headers, timeout=10)
-        resp.raise_for_status()
-        
-        root = ET.fromstring(resp.content)
+def _parse_feed_entry(item, namespace):
+    """Extracts (title, url) from an RSS <item> or Atom <entry> element."""
+    title_tag = item.find(f"{namespace}title")
+    if title_tag is None: title_tag = item.find("title")
+    title = title_tag.text if (title_tag is not None and title_tag.text) else "Untitled Story"
+
+    url = ""
+    # Robust Atom Link Extraction (Prefer rel="alternate" or None)
+    if namespace:
+        links = item.findall(f"{namespace}link")
+        for link in links:
+            rel = link.attrib.get("rel")
+            if rel in (None, "", "alternate"):
+                url = link.attrib.get("href")
+                if url:
+                    break
+    else:
+        # Standard RSS
+        link_tag = item.find("link")
+        if link_tag is not None:
+            url = link_tag.text
+    return title, url
+
+def _iter_feed_entries(content: bytes):
+    """Yields (title, url) per entry in document order; streams with lxml when available."""
+    if etree is None:
+        root = ET.fromstring(content)
         items = root.findall("./channel/item")
         namespace = ""
         if not items:
-            namespace = "{http://www.w3.org/2005/Atom}"
+            namespace = ATOM_NS
             items = root.findall(f"{namespace}entry")
+        for item in items:
+            yield _parse_feed_entry(item, namespace)
+        return
 
-        candidates = []
-        for i, item in enumerate(items[:limit]):
-            title_tag = item.find(f"{namespace}title")
-            if title_tag is None: title_tag = item.find("title")
-            title = title_tag.text if (title_tag is not None and title_tag.text) else "Untitled Story"
-
-            url = ""
-            # Robust Atom Link Extraction (Prefer rel="alternate" or None)
-            if namespace:
-                links = item.findall(f"{namespace}link")
-                for link in links:
-                    rel = link.attrib.get("rel")
-                    if rel in (None, "", "alternate"):
-                        url = link.attrib.get("href")
-                        if url:
-                            break
-            else:
-                # Standard RSS
-                link_tag = item.find("link")
-                if link_tag is not None:
-                    url = link_tag.text
+    context = etree.iterparse(io.BytesIO(content), events=("end",), tag=("item", f"{ATOM_NS}entry"),
+                              resolve_entities=False)
+    for _, elem in context:
+        namespace = ATOM_NS if elem.tag.startswith(ATOM_NS) else ""
+        yield _parse_feed_entry(elem, namespace)
+        # Drop processed entries so the tree never holds the whole feed
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def fetch_rss_feed(feed_url, limit=3):
+    """Generic fetcher for ANY RSS feed."""
+    try:
+        resp = SESSION.get(feed_url, timeout=10)
+        resp.raise_for_status()
 
+        candidates = []
+        # Stop parsing as soon as we have enough stories
+        for i, (title, url) in enumerate(_iter_feed_entries(resp.content)):
             if url:
                 candidates.append({"title": title, "url": url, "score": 100 - i})
+                if len(candidates) == limit: break
         return candidates
     except Exception as e:
         logger.error(f"RSS Fetch failed for {feed_url}: {e}")
@@ -74,19 +122,26 @@ def fetch_hn_top_stories(limit=3, scan_depth=30):
                 return (1 / rank) * math.exp(-age_hours / 24)
             except: return 0
 
-        resp = requests.get("https://hacker-news.firebaseio.com/v0/topstories.json", timeout=10)
+        def fetch_item(ranked_id):
+            rank, sid = ranked_id
+            try:
+                item_resp = SESSION.get(f"https://hacker-news.firebaseio.com/v0/item/{sid}.json", timeout=10)
+                if item_resp.status_code == 200:
+                    return rank, item_resp.json()
+            except Exception: pass
+            return rank, None
+
+        resp = SESSION.get("https://hacker-news.firebaseio.com/v0/topstories.json", timeout=10)
         resp.raise_for_status()
         top_ids = resp.json()[:scan_depth]
+        with ThreadPoolExecutor(max_workers=HN_WORKERS) as executor:
+            results = list(executor.map(fetch_item, enumerate(top_ids, start=1)))
+
         candidates = []
-        for rank, sid in enumerate(top_ids, start=1):
-            try:
-                item_resp = requests.get(f"https://hacker-news.firebaseio.com/v0/item/{sid}.json", timeout=10)
-                if item_resp.status_code == 200:
-                    data = item_resp.json()
-                    if "url" in data and "title" in data:
-                        score = calculate_hotness(rank, data.get("time", 0))
-                        candidates.append({"title": data["title"], "url": data["url"], "score": score})
-            except Exception: continue
+        for rank, data in results:
+            if data and "url" in data and "title" in data:
+                score = calculate_hotness(rank, data.get("time", 0))
+                candidates.append({"title": data["title"], "url": data["url"], "score": score})
         candidates.sort(key=lambda x: x['score'], reverse=True)
         return candidates[:limit]
     except Exception as e:
@@ -97,6 +152,8 @@ def fetch_hn_top_stories(limit=3, scan_depth=30):
 # Fix: Broader regex to capture URLs with parentheses (Wikipedia style)
 URL_RE = re.compile(r'https?://\S+')
 
+# Pure str -> str: the same URLs are normalized at seed, filter, dedup and validation time
+@functools.lru_cache(maxsize=2048)
 def _clean_raw_url(u: str) -> str:
     try: u = unquote(u)
     except: pass
@@ -110,6 +167,7 @@ def _clean_raw_url(u: str) -> str:
         u = u[:-1]
     return u
 
+@functools.lru_cache(maxsize=2048)
 def normalize_url(u: str) -> str:
     if not u: return ""
     try:
@@ -130,29 +188,19 @@ def normalize_url(u: str) -> str:
     except: return u
 
 def extract_urls(text: str) -> list[str]:
-    urls = []
-    for m in URL_RE.finditer(text):
-        raw = _clean_raw_url(m.group(0))
-        norm = normalize_url(raw)
-        if norm: urls.append(norm)
-    return urls
+    return [norm for raw in URL_RE.findall(text) if (norm := normalize_url(_clean_raw_url(raw)))]
 
 # --- 3. ROBUST VALIDATION ---
 
-def terminal_citation_url(bullet: str) -> str | None:
-    """Finds the last URL in the string, regardless of formatting."""
-    candidates = extract_urls(bullet)
-    if not candidates:
-        return None
-    return candidates[-1]
-
-def validate_analysis(analysis_dict: dict, allowed_urls: list[str]) -> bool:
-    normalized_allowed = {normalize_url(u) for u in allowed_urls}
+def validate_analysis(analysis_dict: dict, normalized_allowed: frozenset[str]) -> bool:
+    """Expects the allowlist as a set of normalize_url(url) values, built once per story."""
     bullets = analysis_dict.get("bullets") or []
     if not bullets: return True
 
     for bullet in bullets:
-        cited_url_norm = terminal_citation_url(bullet)
+        # Extract once; the terminal citation is simply the last URL found
+        found_urls = extract_urls(bullet)
+        cited_url_norm = found_urls[-1] if found_urls else None
         
         if not cited_url_norm:
              raise ValueError(f"Bullet has no citation URL. Text: {bullet[-50:]}")
@@ -160,13 +208,45 @@ def validate_analysis(analysis_dict: dict, allowed_urls: list[str]) -> bool:
         if cited_url_norm not in normalized_allowed:
             raise ValueError(f"Citation URL not in allowlist: {cited_url_norm}")
 
-        found_urls = extract_urls(bullet)
         for u in found_urls:
             if u != cited_url_norm and u not in normalized_allowed:
                  raise ValueError(f"Hallucinated URL in text body: {u}")
     return True
 
-# --- 4. FINANCIALS (HYBRID: THREADS FOR WINDOWS, PROCESS FOR LINUX) ---
+# --- 4. FINANCIALS (DAEMON WORKERS + PER-RUN CACHE) ---
+# Shared workers: no process spawn or Queue pickling per story. They are daemon
+# threads (unlike ThreadPoolExecutor's, which are joined at exit), so a hung
+# yfinance call is abandoned at shutdown instead of keeping the process alive.
+MARKET_WORKERS = 2
+_MARKET_QUEUE = queue.SimpleQueue()
+
+def _market_worker():
+    while True:
+        future, ticker = _MARKET_QUEUE.get()
+        if not future.set_running_or_notify_cancel(): continue
+        try: future.set_result(_fetch_ticker_info(ticker))
+        except Exception as e: future.set_exception(e)
+
+_market_workers_lock = threading.Lock()
+_market_workers_started = False
+
+def _ensure_market_workers():
+    """Starts the workers on first use, so importing tools never spawns threads."""
+    global _market_workers_started
+    with _market_workers_lock:
+        if _market_workers_started: return
+        for i in range(MARKET_WORKERS):
+            threading.Thread(target=_market_worker, name=f"yfin_{i}", daemon=True).start()
+        _market_workers_started = True
+
+def _submit_market_fetch(ticker) -> Future:
+    _ensure_market_workers()
+    future = Future()
+    _MARKET_QUEUE.put((future, ticker))
+    return future
+
+# Prices are treated as fixed for the length of one batch run
+@functools.lru_cache(maxsize=32)
 def _fetch_ticker_info(ticker):
     """The actual logic to fetch data."""
     stock = yf.Ticker(ticker)
@@ -177,61 +257,60 @@ def _fetch_ticker_info(ticker):
         
     return get_val(info, 'last_price'), get_val(info, 'previous_close')
 
-def _fetch_ticker_info_process(ticker, q):
-    """Wrapper for Multiprocessing."""
-    try: 
-        q.put(_fetch_ticker_info(ticker))
-    except Exception: 
-        q.put((None, None))
+TICKER_MAP = {"NVIDIA": "NVDA", "Tesla": "TSLA", "Apple": "AAPL", "Google": "GOOGL", 
+              "Microsoft": "MSFT", "Amazon": "AMZN", "Meta": "META", "Facebook": "META"}
+TICKER_MAP_LOWER = {company.lower(): ticker for company, ticker in TICKER_MAP.items()}
+# Single alternation: one pass over the text instead of one search per company
+_TICKER_RE = re.compile(r'\b(' + '|'.join(re.escape(c) for c in TICKER_MAP_LOWER) + r')\b')
 
 def safe_get_market_snapshot(text: str, timeout=5) -> str:
-    ticker_map = {"NVIDIA": "NVDA", "Tesla": "TSLA", "Apple": "AAPL", "Google": "GOOGL", 
-                  "Microsoft": "MSFT", "Amazon": "AMZN", "Meta": "META", "Facebook": "META"}
-    
-    text_lower = text.lower()
-    
-    found_ticker = None
-    for company, ticker in ticker_map.items():
-        pattern = r'\b' + re.escape(company.lower()) + r'\b'
-        if re.search(pattern, text_lower):
-            found_ticker = ticker
-            break
-            
-    if not found_ticker: return ""
-
-    # STRATEGY SELECTION BASED ON OS
-    if os.name == 'nt':
-        # --- WINDOWS STRATEGY (Threads) ---
-        # Note: Threads cannot be hard-killed on Windows. 
-        # We unblock the main program on timeout, but the worker thread may linger until script exit.
-        executor = ThreadPoolExecutor(max_workers=1)
-        try:
-            future = executor.submit(_fetch_ticker_info, found_ticker)
-            price, prev = future.result(timeout=timeout)
-        except TimeoutError:
-            logger.warning(f"Market data timed out for {found_ticker}")
-            return ""
-        except Exception:
-            return ""
-        finally:
-            executor.shutdown(wait=False, cancel_futures=True)
-    else:
-        # --- LINUX/PROD STRATEGY (Multiprocessing) ---
-        q = Queue()
-        p = Process(target=_fetch_ticker_info_process, args=(found_ticker, q))
-        p.start()
-        p.join(timeout)
-
-        if p.is_alive():
-            p.terminate()
-            p.join()
-            logger.warning(f"Market data timed out for {found_ticker} (Process Killed)")
-            return ""
-
-        if q.empty(): return ""
-        price, prev = q.get()
-
-    # Common Formatting Logic
+    match = _TICKER_RE.search(text.lower())
+    if not match: return ""
+    found_ticker = TICKER_MAP_LOWER[match.group(1)]
+
+    try:
+        future = _submit_market_fetch(found_ticker)
+        price, prev = future.result(timeout=timeout)
+    except TimeoutError:
+        logger.warning(f"Market data timed out for {found_ticker}")
+        return ""
+    except Exception:
+        return ""
+
     if not price or not prev or prev == 0: return ""
     pct = ((price - prev) / prev) * 100
     return f" ({found_ticker}: ${price:.2f} {pct:+.1f}%)"
+
+# --- 5. RATE LIMITING ---
+class SlidingWindowLimiter:
+    """Proactive per-provider limiter: at most `rpm` requests and `tpm` tokens in any rolling window."""
+
+    def __init__(self, rpm: int, tpm: int | None = None, window: float = 60.0):
+        self.rpm, self.tpm, self.window = rpm, tpm, window
+        self._events = deque()  # (monotonic timestamp, tokens)
+        self._tokens = 0
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def defer(self, seconds: float):
+        """Pauses every caller, e.g. after a 429 that says when to come back."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, tokens: int = 0):
+        # The lock keeps waiters FIFO so one large request isn't starved by small ones
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= self.window:
+                    self._tokens -= self._events.popleft()[1]
+
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    under_rpm = len(self._events) < self.rpm
+                    under_tpm = self.tpm is None or not self._events or self._tokens + tokens <= self.tpm
+                    if under_rpm and under_tpm:
+                        self._events.append((now, tokens))
+                        self._tokens += tokens
+                        return
+                    wait = self._events[0][0] + self.window - now
+                await asyncio.sleep(wait)